@@ -0,0 +1,50 @@
+"""
+gmail_priority/llm_cache.py
+
+Small persistent key/value store for Claude responses, so emails that were
+already scored on a previous run are not sent to Claude again.
+"""
+
+import sqlite3
+import time
+from pathlib import Path
+
+HERE = Path(__file__).parent
+DB_PATH = HERE / ".llm_cache.sqlite"
+
+_conn = None
+
+
+def _connect():
+    """Return the shared SQLite connection, creating the database on first use."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(str(DB_PATH))
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+    return _conn
+
+
+def get(key):
+    """Return the cached string for key, or None if it has not been stored."""
+    row = _connect().execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set(key, value):
+    """Store a string value under key, replacing any previous value."""
+    conn = _connect()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, created_at) VALUES (?, ?, ?)",
+            (key, value, time.time()),
+        )
+
+
+def prune(max_age_seconds):
+    """Delete entries stored more than max_age_seconds ago."""
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - max_age_seconds,))
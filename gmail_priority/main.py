@@ -6,19 +6,29 @@ Fetches unread Gmail messages from the last 24 hours, scores each one
 priority 1-5 using Claude, and posts a full prioritized digest to Slack.
 """
 
+import asyncio
+import hashlib
 import json
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple
 
-import anthropic
+import google_auth_httplib2
 import requests
 from dotenv import load_dotenv
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest, build_http
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import llm_cache
 
 # Resolve paths relative to this file so the script works from any CWD
 HERE = Path(__file__).parent
@@ -26,6 +36,9 @@ load_dotenv(HERE.parent / ".env")
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 TOKEN_PATH = HERE / "token.json"
+GMAIL_BATCH_SIZE = 50
+GMAIL_FETCH_WORKERS = 10
+GMAIL_FETCH_RETRIES = 3
 
 
 def find_credentials_file():
@@ -57,6 +70,16 @@ PRIORITY_EMOJI = {1: "⚪", 2: "🟢", 3: "🔵", 4: "🟠", 5: "🔴"}
 
 # ── Gmail ─────────────────────────────────────────────────────────────────────
 
+class Email(NamedTuple):
+    """Metadata for one inbox message; a tuple, so no per-record __dict__."""
+
+    id: str
+    thread_id: str
+    sender: str
+    subject: str
+    snippet: str
+
+
 def get_gmail_service():
     """Return an authenticated Gmail API service, refreshing/creating OAuth tokens as needed."""
     creds = None
@@ -74,35 +97,103 @@ def get_gmail_service():
 
         TOKEN_PATH.write_text(creds.to_json())
 
-    return build("gmail", "v1", credentials=creds)
+    # httplib2.Http is not thread-safe, so give each thread its own
+    # authorized connection instead of sharing the service's default one.
+    # build_http() keeps the library's default socket timeout.
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(local, "http"):
+            local.http = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+        return HttpRequest(local.http, *args, **kwargs)
+
+    # Use the discovery document bundled with google-api-python-client rather
+    # than fetching it over the network on every run.
+    return build(
+        "gmail",
+        "v1",
+        credentials=creds,
+        requestBuilder=build_request,
+        static_discovery=True,
+        cache_discovery=False,
+    )
+
+
+def _get_message_request(service, message_id):
+    """Return an unexecuted messages.get request for a message's Subject/From metadata."""
+    return service.users().messages().get(
+        userId="me",
+        id=message_id,
+        format="metadata",
+        metadataHeaders=["Subject", "From"],
+        # Partial response: skip labelIds, sizeEstimate, internalDate, etc.
+        fields="id,threadId,snippet,payload/headers(name,value)",
+    )
+
+
+def _parse_message(msg):
+    """Convert a metadata-format Gmail message resource into an Email."""
+    headers = {
+        h["name"]: h["value"]
+        for h in msg.get("payload", {}).get("headers", [])
+    }
+    return Email(
+        id=msg["id"],
+        thread_id=msg["threadId"],
+        sender=headers.get("From", "(unknown)"),
+        subject=headers.get("Subject", "(no subject)"),
+        snippet=msg.get("snippet", ""),
+    )
 
 
 def fetch_unread_emails(service):
-    """Return a list of dicts with id, subject, sender, and snippet for all inbox emails."""
-    result = service.users().messages().list(userId="me", q="in:inbox category:primary", maxResults=100).execute()
+    """Return a list of Emails (id, thread_id, sender, subject, snippet) for all inbox emails."""
+    result = service.users().messages().list(
+        userId="me",
+        q="in:inbox category:primary",
+        maxResults=100,
+        fields="messages/id",
+    ).execute()
     message_stubs = result.get("messages", [])
 
-    emails = []
-    for stub in message_stubs:
-        msg = service.users().messages().get(
-            userId="me",
-            id=stub["id"],
-            format="metadata",
-            metadataHeaders=["Subject", "From"],
-        ).execute()
-
-        headers = {
-            h["name"]: h["value"]
-            for h in msg.get("payload", {}).get("headers", [])
-        }
-        emails.append({
-            "id": stub["id"],
-            "subject": headers.get("Subject", "(no subject)"),
-            "sender": headers.get("From", "(unknown)"),
-            "snippet": msg.get("snippet", ""),
-        })
-
-    return emails
+    messages = {}
+    failed = []
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            failed.append(request_id)
+        else:
+            messages[request_id] = response
+
+    # Fetch metadata in batches rather than one HTTP round-trip per message.
+    # Gmail caps a batch at 100 calls but recommends staying at 50 or below.
+    for start in range(0, len(message_stubs), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for stub in message_stubs[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(_get_message_request(service, stub["id"]), request_id=stub["id"])
+        batch.execute()
+
+    # Calls inside a batch can fail individually (typically rate limiting);
+    # retry those as concurrent standalone requests, letting the client back
+    # off exponentially on 429/5xx rather than failing on the first repeat.
+    def fetch_one(message_id):
+        return _get_message_request(service, message_id).execute(num_retries=GMAIL_FETCH_RETRIES)
+
+    if failed:
+        with ThreadPoolExecutor(max_workers=GMAIL_FETCH_WORKERS) as pool:
+            for msg in pool.map(fetch_one, failed):
+                messages[msg["id"]] = msg
+
+    return [_parse_message(messages[stub["id"]]) for stub in message_stubs]
+
+
+def latest_per_thread(emails):
+    """Return only the newest email of each thread, keeping list order."""
+    # Gmail lists newest first, so the first message seen per thread is the latest
+    latest = {}
+    for e in emails:
+        latest.setdefault(e.thread_id, e)
+    return list(latest.values())
 
 
 def gmail_link(message_id):
@@ -112,20 +203,18 @@ def gmail_link(message_id):
 
 # ── Claude ────────────────────────────────────────────────────────────────────
 
-def score_emails(emails):
-    """
-    Send all emails to Claude in one call and return a list of
-    {"priority": int, "reason": str, "action_needed": bool} dicts, one per email (same order).
-    """
-    client = anthropic.Anthropic()
+CLAUDE_CONCURRENCY = 8
 
-    numbered = "\n\n".join(
-        f"[{i + 1}]\nFrom: {e['sender']}\nSubject: {e['subject']}\nSnippet: {e['snippet']}"
-        for i, e in enumerate(emails)
-    )
+# Triage with a fast, cheap model; re-score only the borderline results
+# with the larger model, where the extra judgement actually matters.
+TRIAGE_MODEL = "claude-haiku-4-5"
+ESCALATION_MODEL = "claude-opus-4-6"
+ESCALATE_PRIORITIES = (3, 4)
 
-    prompt = f"""\
-You are an email triage assistant. Score each email's priority and summarise it.
+# Static part of the prompt, sent as a cached system block. Keep it free of
+# per-run data: the prompt cache only hits on a byte-identical prefix.
+TRIAGE_RUBRIC = """\
+You are an email triage assistant. Score the email's priority and summarise it.
 
 Priority scale:
   5 – Urgent: requires immediate action (e.g. outages, deadlines, security alerts)
@@ -134,28 +223,177 @@ Priority scale:
   2 – Low: can wait a few days
   1 – Minimal: newsletters, automated notifications, marketing
 
-Emails:
-{numbered}
+Submit your assessment with the submit_score tool."""
+
+# Built once and shared by every request instead of per call.
+TRIAGE_SYSTEM = [{"type": "text", "text": TRIAGE_RUBRIC, "cache_control": {"type": "ephemeral"}}]
+
+# Forcing this tool makes Claude return the score as structured tool input
+# rather than free-form text that has to be located and parsed. The API does
+# not validate that input against the schema, so _check_score still does.
+SCORE_TOOL = {
+    "name": "submit_score",
+    "description": "Submit the priority assessment for the email.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "priority": {"type": "integer", "minimum": 1, "maximum": 5},
+            "reason": {"type": "string", "description": "One concise sentence summary."},
+            "action_needed": {"type": "boolean"},
+        },
+        "required": ["priority", "reason", "action_needed"],
+    },
+}
+
+
+# Fingerprint of everything that shapes a score, so changing the models or
+# the prompt invalidates cached scores instead of serving stale ones.
+SCORING_VERSION = hashlib.sha256(json.dumps(
+    [TRIAGE_MODEL, ESCALATION_MODEL, ESCALATE_PRIORITIES, TRIAGE_RUBRIC, SCORE_TOOL],
+    sort_keys=True,
+).encode()).hexdigest()
+
+# Cached scores older than this are dropped; an email still in the inbox
+# after that is simply re-scored.
+LLM_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # seconds
+
+
+def _check_score(score):
+    """Return score if it is a well-formed SCORE_TOOL input, otherwise raise ValueError."""
+    required = SCORE_TOOL["input_schema"]["required"]
+    if not isinstance(score, dict) or any(k not in score for k in required):
+        raise ValueError(f"score is missing required fields {required}: {score!r}")
+    priority = score["priority"]
+    if isinstance(priority, bool) or not isinstance(priority, int) or not 1 <= priority <= 5:
+        raise ValueError(f"priority must be an integer from 1 to 5: {score!r}")
+    return score
+
+
+def _cache_key(email):
+    """Return the LLM cache key for an email; changes if its content or the scoring setup does."""
+    return hashlib.sha256(
+        f"{SCORING_VERSION}|{email.id}|{email.subject}|{email.snippet}".encode()
+    ).hexdigest()
 
-Return ONLY a valid JSON array with exactly {len(emails)} objects in the same order, no other text:
-[{{"priority": <1-5>, "reason": "<one concise sentence summary>", "action_needed": <true|false>}}]"""
 
-    response = client.messages.create(
-        model="claude-opus-4-6",
-        max_tokens=4096,
-        messages=[{"role": "user", "content": prompt}],
-    )
+def score_emails(emails):
+    """
+    Return a list of {"priority": int, "reason": str, "action_needed": bool} dicts,
+    one per email (same order).
 
-    text = response.content[0].text.strip()
-    # Strip markdown code fences if present (e.g. ```json ... ```)
-    if text.startswith("```"):
-        text = text.split("\n", 1)[-1]
-        text = text.rsplit("```", 1)[0].strip()
-    return json.loads(text)
+    Scores from previous runs are read from the on-disk LLM cache; only emails
+    without a cached score are sent to Claude.
+    """
+    llm_cache.prune(LLM_CACHE_MAX_AGE)
+
+    keys = [_cache_key(e) for e in emails]
+    cached = (llm_cache.get(k) for k in keys)
+    scores = [json.loads(c) if c is not None else None for c in cached]
+
+    missing = [i for i, s in enumerate(scores) if s is None]
+    if missing:
+        fresh, provisional = _score_with_claude([emails[i] for i in missing])
+        for j, (i, score) in enumerate(zip(missing, fresh)):
+            if not isinstance(score, Exception):
+                # Provisional scores are used for this digest but not cached,
+                # so the next run tries to escalate them again
+                if j not in provisional:
+                    llm_cache.set(keys[i], json.dumps(score))
+                scores[i] = score
+        # Raise only after caching the successes, so a re-run resends just the failures
+        for score in fresh:
+            if isinstance(score, Exception):
+                raise score
+
+    return scores
+
+
+def _score_with_claude(emails):
+    """
+    Score each email with its own concurrent Claude call.
+
+    Returns (scores, provisional): scores in the same order as emails, where a
+    failed call yields its exception in place of a score, and the set of
+    indices whose score is provisional.
+
+    Every email is triaged with TRIAGE_MODEL; those landing on an
+    ESCALATE_PRIORITIES score are re-scored with ESCALATION_MODEL. If that
+    call fails, the triage score is kept and marked provisional.
+    """
+    return asyncio.run(_score_concurrently(emails))
+
+
+async def _score_concurrently(emails):
+    # Imported here so runs where every score comes from the LLM cache (or
+    # there is no mail) don't pay for loading the SDK.
+    import anthropic
+
+    async with anthropic.AsyncAnthropic() as client:
+        semaphore = asyncio.Semaphore(CLAUDE_CONCURRENCY)
+
+        async def score_one(email, model):
+            async with semaphore:
+                response = await client.messages.create(
+                    model=model,
+                    max_tokens=1024,
+                    system=TRIAGE_SYSTEM,
+                    tools=[SCORE_TOOL],
+                    tool_choice={"type": "tool", "name": SCORE_TOOL["name"]},
+                    messages=[{
+                        "role": "user",
+                        "content": f"From: {email.sender}\nSubject: {email.subject}\nSnippet: {email.snippet}",
+                    }],
+                )
+
+            # Raised here, a malformed reply fails only this email's score
+            tool_input = next((b.input for b in response.content if b.type == "tool_use"), None)
+            return _check_score(tool_input)
+
+        async def score_all(batch, model):
+            return await asyncio.gather(*(score_one(e, model) for e in batch), return_exceptions=True)
+
+        scores = await score_all(emails, TRIAGE_MODEL)
+        provisional = set()
+
+        ambiguous = [
+            i for i, s in enumerate(scores)
+            if not isinstance(s, Exception) and s["priority"] in ESCALATE_PRIORITIES
+        ]
+        if ambiguous:
+            rescored = await score_all([emails[i] for i in ambiguous], ESCALATION_MODEL)
+            for i, score in zip(ambiguous, rescored):
+                # Escalation only refines the triage score; keep that one if it fails
+                if isinstance(score, Exception):
+                    print(f"  {ESCALATION_MODEL} re-score failed for {emails[i].id}, keeping triage score: {score}", file=sys.stderr)
+                    provisional.add(i)
+                else:
+                    scores[i] = score
+
+        return scores, provisional
 
 
 # ── Slack ─────────────────────────────────────────────────────────────────────
 
+# Shared session so webhook posts reuse pooled TLS connections. The webhook
+# POST is not idempotent, so only retry when Slack clearly did not process it:
+# connection failures (urllib3's default handling) and 429 rate limiting.
+# After a read timeout or a 5xx the digest may already have been posted, so
+# those are not retried. POST has to be listed for the 429 retry to apply.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429],
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+))
+
+
 def post_digest_to_slack(webhook_url, emails, scores):
     """Post action-needed emails to Slack, sorted by priority descending."""
     paired = sorted(
@@ -169,16 +407,16 @@ def post_digest_to_slack(webhook_url, emails, scores):
 
     for email, score in paired:
         emoji = PRIORITY_EMOJI.get(score["priority"], "⚪")
-        link = gmail_link(email["id"])
+        link = gmail_link(email.id)
         lines.append(
-            f"{emoji} *[{score['priority']}] {email['subject']}*\n"
-            f"From: {email['sender']}\n"
+            f"{emoji} *[{score['priority']}] {email.subject}*\n"
+            f"From: {email.sender}\n"
             f"_{score['reason']}_\n"
             f"<{link}|Open in Gmail>"
         )
 
     text = "\n\n".join(lines)
-    resp = requests.post(webhook_url, json={"text": text}, timeout=10)
+    resp = _SESSION.post(webhook_url, json={"text": text}, timeout=(3, 30))
     resp.raise_for_status()
 
 
@@ -200,6 +438,10 @@ def main():
         print("Nothing to process.")
         return
 
+    # Score and report each conversation once, by its newest message
+    emails = latest_per_thread(emails)
+    print(f"  {len(emails)} thread(s) to score.")
+
     print("Scoring with Claude…")
     scores = score_emails(emails)
 